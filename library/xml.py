@@ -1,5 +1,6 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+# cython: language_level=3, boundscheck=False
 
 # Copyright 2014, Red Hat, Inc.
 # Tim Bielawa <tbielawa@redhat.com>
@@ -178,8 +179,12 @@ EXAMPLES = r'''
 
 RETURN = r'''# '''
 
+import copy
+import functools
+import hashlib
 import os
 import re
+import stat
 import traceback
 
 from io import BytesIO
@@ -191,79 +196,112 @@ try:
 except ImportError:
     HAS_LXML = False
 
-try:
-    import json
-except:
-    import simplejson as json
+import json
 
 from ansible.module_utils.basic import AnsibleModule, get_exception
 from ansible.module_utils.six import iteritems
 
+# Shared parsers: this module never looks elements up by xml:id, so skip
+# building libxml2's id hash table for every document parsed
+if HAS_LXML:
+    try:
+        _PARSER = etree.XMLParser(collect_ids=False)
+        _PARSER_PRETTY = etree.XMLParser(collect_ids=False, remove_blank_text=True)
+    except TypeError:
+        # collect_ids needs lxml >= 3.5
+        _PARSER = etree.XMLParser()
+        _PARSER_PRETTY = etree.XMLParser(remove_blank_text=True)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_xpath(xpath, ns_items):
+    """ Compile an XPath expression once and cache it.
+
+    Compiling the expression dominates the cost of the short xpaths this
+    module deals with, and the same xpath is typically evaluated several
+    times per invocation. ns_items is a frozenset of namespace items so
+    the cache key is hashable."""
+    return etree.XPath(xpath, namespaces=dict(ns_items))
+
+
+def xpath_eval(tree, xpath, namespaces):
+    """ Evaluate an xpath against a tree through the compiled-xpath cache """
+    return _compile_xpath(xpath, frozenset(namespaces.items()))(tree)
+
+
+def _tree_snippet(tree, limit=4096):
+    """ Serialize a tree for an error message, capped so a large document
+    never lands wholesale in fail_json output """
+    s = etree.tostring(tree, pretty_print=True)
+    if len(s) > limit:
+        return s[:limit] + b"...<truncated>"
+    return s
+
+
+# getpath() walks from each match to the root; past this many matches just
+# report the count instead of paying O(matches * depth)
+_GETPATH_LIMIT = 1000
+
+# Hash of the source file's bytes, captured at parse time so finish() can
+# skip rewriting the file when the result is byte-identical
+_src_hash = None
+
 
 def print_match(module, tree, xpath, namespaces):
-    match = tree.xpath(xpath, namespaces=namespaces)
-    match_xpaths = []
-    for m in match:
-        match_xpaths.append(tree.getpath(m))
-    match_str = json.dumps(match_xpaths)
+    match = xpath_eval(tree, xpath, namespaces)
+    if len(match) > _GETPATH_LIMIT:
+        match_str = json.dumps("<%d matches>" % len(match))
+    else:
+        match_xpaths = []
+        for m in match:
+            if isinstance(m, lxml.etree._Element):
+                match_xpaths.append(tree.getpath(m))
+            elif getattr(m, 'attrname', None):
+                # attribute string result: its parent's path plus the name
+                match_xpaths.append("%s/@%s" % (tree.getpath(m.getparent()), m.attrname))
+            else:
+                # text string result
+                match_xpaths.append("%s/text()" % tree.getpath(m.getparent()))
+        match_str = json.dumps(match_xpaths, separators=(',', ':'))
     msg = "selector '%s' match: %s" % (xpath, match_str)
     finish(module, tree, xpath, namespaces, changed=False, msg=msg)
 
 
 def count_nodes(module, tree, xpath, namespaces):
     """ Return the count of nodes matching the xpath """
-    hits = tree.xpath("count(/%s)" % xpath, namespaces=namespaces)
-    finish(module, tree, xpath, namespaces, changed=False, msg=int(hits), hitcount=int(hits))
+    # len() of the compiled expression's node set shares a cache entry with
+    # every other operation on the same xpath, unlike a count(...) wrapper
+    hits = len(xpath_eval(tree, xpath, namespaces))
+    finish(module, tree, xpath, namespaces, changed=False, msg=hits, hitcount=hits)
 
 
 def is_node(tree, xpath, namespaces):
     """ Test if a given xpath matches anything and if that match is a node.
 
     For now we just assume you're only searching for one specific thing."""
-    if xpath_matches(tree, xpath, namespaces):
-        # OK, it found something
-        match = tree.xpath(xpath, namespaces=namespaces)
-        if isinstance(match[0], lxml.etree._Element):
-            return True
-
-    return False
-
-
-def is_attribute(tree, xpath, namespaces):
-    """ Test if a given xpath matches and that match is an attribute
-
-    An xpath attribute search will only match one item"""
-    if xpath_matches(tree, xpath, namespaces):
-        match = tree.xpath(xpath, namespaces=namespaces)
-        if isinstance(match[0], lxml.etree._ElementStringResult):
-            return True
-    return False
-
-
-def xpath_matches(tree, xpath, namespaces):
-    """ Test if a node exists """
-    if tree.xpath(xpath, namespaces=namespaces):
-        return True
-    else:
-        return False
+    match = xpath_eval(tree, xpath, namespaces)
+    return bool(match) and isinstance(match[0], lxml.etree._Element)
 
 
 def delete_xpath_target(module, tree, xpath, namespaces):
     """ Delete an attribute or element from a tree """
     try:
-        for result in tree.xpath(xpath, namespaces=namespaces):
+        for result in xpath_eval(tree, xpath, namespaces):
             if not module.check_mode:
-                # Get the xpath for this result
-                if is_attribute(tree, xpath, namespaces):
-                    # Delete an attribute
-                    parent = result.getparent()
-                    # Pop this attribute match out of the parent
-                    # node's 'attrib' dict by using this match's
-                    # 'attrname' attribute for the key
-                    parent.attrib.pop(result.attrname)
-                elif is_node(tree, xpath, namespaces):
+                # Classify each result directly instead of re-running the
+                # xpath per match
+                if isinstance(result, lxml.etree._Element):
                     # Delete an element
                     result.getparent().remove(result)
+                elif result.attrname is not None:
+                    # An attribute match comes back as a string result;
+                    # pop it out of the parent node's 'attrib' dict by
+                    # using this match's 'attrname' attribute for the key
+                    result.getparent().attrib.pop(result.attrname)
+                else:
+                    # a string result without an attrname is a text()
+                    # match, which has no standalone existence to remove
+                    module.fail_json(msg="Cannot delete a text() match for xpath %s; delete the parent element instead" % xpath)
     except Exception:
         e = get_exception()
         module.fail_json(msg="Couldn't delete xpath target: %s (%s)" % (xpath, e))
@@ -272,33 +310,42 @@ def delete_xpath_target(module, tree, xpath, namespaces):
 
 
 def replace_children_of(children, match):
-    for element in match.getchildren():
-        match.remove(element)
+    # one C-level slice delete instead of a remove() per child
+    del match[:]
     match.extend(children)
 
 
+def _elements_equal(a, b):
+    """ Compare two elements structurally, bailing on the first difference """
+    if a.tag != b.tag or a.text != b.text or a.tail != b.tail:
+        return False
+    if dict(a.attrib) != dict(b.attrib):
+        return False
+    if len(a) != len(b):
+        return False
+    return all(_elements_equal(c, d) for c, d in zip(a, b))
+
+
 def set_target_children_inner(module, tree, xpath, namespaces, children, in_type):
-    matches = tree.xpath(xpath, namespaces=namespaces)
+    matches = xpath_eval(tree, xpath, namespaces)
 
     # Create a list of our new children
     children = children_to_nodes(module, children, in_type)
-    children_as_string = [lxml.etree.tostring(c) for c in children]
 
     changed = False
 
     # xpaths always return matches as a list, so....
     for match in matches:
-        # Check if elements differ
-        if len(match.getchildren()) == len(children):
-            for idx, element in enumerate(match.getchildren()):
-                if lxml.etree.tostring(element) != children_as_string[idx]:
-                    if not module.check_mode:
-                        replace_children_of(children, match)
-                    changed = True
-                    break
-        else:
+        # Check if elements differ; comparing structurally avoids
+        # serializing every child on both sides just to test equality
+        existing = list(match)
+        if len(existing) != len(children) or \
+                any(not _elements_equal(e, c) for e, c in zip(existing, children)):
             if not module.check_mode:
-                replace_children_of(children, match)
+                # extend() moves nodes out of their previous parent, so each
+                # match past the first would otherwise receive an empty list;
+                # give every match its own copy of the new children
+                replace_children_of([copy.deepcopy(c) for c in children], match)
             changed = True
 
     return changed
@@ -313,7 +360,7 @@ def set_target_children(module, tree, xpath, namespaces, children, in_type):
 def add_target_children(module, tree, xpath, namespaces, children, in_type):
     if is_node(tree, xpath, namespaces):
         new_kids = children_to_nodes(module, children, in_type)
-        for node in tree.xpath(xpath, namespaces=namespaces):
+        for node in xpath_eval(tree, xpath, namespaces):
             if not module.check_mode:
                 node.extend(new_kids)
         finish(module, tree, xpath, namespaces, changed=True)
@@ -326,15 +373,21 @@ _nsIdent = _ident + "|" + _ident + ":" + _ident
 # strings wrapped by the other delimiter' XPath trick, especially as simple XPath.
 _xpstr = "('(?:.*)'|\"(?:.*)\")"
 
-_re_splitSimpleLast = re.compile("^(.*)/(" + _nsIdent + ")$")
-_re_splitSimpleLastEqValue = re.compile("^(.*)/(" + _nsIdent + ")/text\\(\\)=" + _xpstr + "$")
-_re_splitSimpleAttrLast = re.compile("^(.*)/(@(?:" + _nsIdent + "))$")
-_re_splitSimpleAttrLastEqValue = re.compile("^(.*)/(@(?:" + _nsIdent + "))=" + _xpstr + "$")
-
-_re_splitSubLast = re.compile("^(.*)/(" + _nsIdent + ")\\[(.*)\\]$")
+# All the "last segment" forms folded into one alternation so classifying an
+# xpath costs a single pass through the regex engine instead of up to six
+_re_splitLast = re.compile(
+    "^(?P<inner>.*)/(?:"
+    "(?P<attr_eq>@(?:" + _nsIdent + "))=(?P<attr_val>" + _xpstr + ")"
+    "|(?P<attr>@(?:" + _nsIdent + "))"
+    "|(?P<elem_eq>" + _nsIdent + ")/text\\(\\)=(?P<elem_val>" + _xpstr + ")"
+    "|(?P<sub>" + _nsIdent + ")\\[(?P<pred>.*)\\]"
+    "|(?P<elem>" + _nsIdent + ")"
+    ")$")
 
 _re_splitOnlyEqValue = re.compile("^(.*)/text\\(\\)=" + _xpstr + "$")
 
+_re_simplePath = re.compile("^(?:/(?:" + _nsIdent + "))+$")
+
 
 def _extract_xpstr(g):
     return g[1:-1]
@@ -343,29 +396,25 @@ def _extract_xpstr(g):
 def split_xpath_last(xpath):
     """split an XPath of the form /foo/bar/baz into /foo/bar and baz"""
     xpath = xpath.strip()
-    m = _re_splitSimpleLast.match(xpath)
-    if m:
-        # requesting an element to exist
-        return (m.group(1), [(m.group(2), None)])
-    m = _re_splitSimpleLastEqValue.match(xpath)
-    if m:
-        # requesting an element to exist with an inner text
-        return (m.group(1), [(m.group(2), _extract_xpstr(m.group(3)))])
-
-    m = _re_splitSimpleAttrLast.match(xpath)
+    m = _re_splitLast.match(xpath)
     if m:
-        # requesting an attribute to exist
-        return (m.group(1), [(m.group(2), None)])
-    m = _re_splitSimpleAttrLastEqValue.match(xpath)
-    if m:
-        # requesting an attribute to exist with a value
-        return (m.group(1), [(m.group(2), _extract_xpstr(m.group(3)))])
-
-    m = _re_splitSubLast.match(xpath)
-    if m:
-        content = map(lambda x: x.strip(), m.group(3).split(" and "))
-
-        return (m.group(1), [('/' + m.group(2), content)])
+        inner = m.group('inner')
+        if m.group('elem'):
+            # requesting an element to exist
+            return (inner, [(m.group('elem'), None)])
+        if m.group('elem_eq'):
+            # requesting an element to exist with an inner text
+            return (inner, [(m.group('elem_eq'), _extract_xpstr(m.group('elem_val')))])
+        if m.group('attr'):
+            # requesting an attribute to exist
+            return (inner, [(m.group('attr'), None)])
+        if m.group('attr_eq'):
+            # requesting an attribute to exist with a value
+            return (inner, [(m.group('attr_eq'), _extract_xpstr(m.group('attr_val')))])
+        if m.group('sub'):
+            content = [x.strip() for x in m.group('pred').split(" and ")]
+
+            return (inner, [('/' + m.group('sub'), content)])
 
     m = _re_splitOnlyEqValue.match(xpath)
     if m:
@@ -374,82 +423,140 @@ def split_xpath_last(xpath):
     return (xpath, [])
 
 
-def nsnameToClark(name, namespaces):
+@functools.lru_cache(maxsize=1024)
+def _nsname_to_clark(name, ns_items):
     if ":" in name:
         (nsname, rawname) = name.split(":")
-        # return "{{%s}}%s" % (namespaces[nsname], rawname)
-        return "{{{0}}}{1}".format(namespaces[nsname], rawname)
+        uri = dict(ns_items)[nsname]
+        return f"{{{uri}}}{rawname}"
     else:
         # no namespace name here
         return name
 
 
+def nsnameToClark(name, namespaces):
+    # check_or_make_target converts the same handful of names once per
+    # recursion level, so cache on (name, namespace items)
+    return _nsname_to_clark(name, frozenset(namespaces.items()))
+
+
+def simple_path_segments(xpath, namespaces):
+    """ Return the Clark-notation segments of a plain child-axis xpath,
+    or None if the xpath uses anything beyond simple /a/b/c steps """
+    if not _re_simplePath.match(xpath):
+        return None
+    try:
+        return [nsnameToClark(segment, namespaces) for segment in xpath.strip('/').split('/')]
+    except KeyError:
+        # unknown namespace prefix; let the regular parse report it
+        return None
+
+
+def stream_matches(infile, segments):
+    """ Yield elements matching a simple absolute path via iterparse,
+    without ever materializing the full tree.
+
+    Already-processed parts of the document are cleared as parsing
+    proceeds, so memory stays constant for arbitrarily large inputs. """
+    ancestry = segments[:-1]
+    for event, elem in etree.iterparse(infile, tag=segments[-1]):
+        lineage = []
+        parent = elem.getparent()
+        while parent is not None:
+            lineage.append(parent.tag)
+            parent = parent.getparent()
+        lineage.reverse()
+        if lineage == ancestry:
+            yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
 def check_or_make_target(module, tree, xpath, namespaces):
-    (inner_xpath, changes) = split_xpath_last(xpath)
-    if (inner_xpath == xpath) or (changes is None):
-        module.fail_json(msg="Can't process Xpath %s in order to spawn nodes! tree is %s" %
-                             (xpath, etree.tostring(tree, pretty_print=True)))
-        return False
+    # Peel the xpath apart leaf-to-root until we reach a node that already
+    # exists, then walk back down applying each missing segment in turn.
+    # This splits and tests each level once, where the old recursive
+    # version re-derived the whole chain at every depth.
+    segments = []
+    while True:
+        (inner_xpath, changes) = split_xpath_last(xpath)
+        if (inner_xpath == xpath) or (changes is None):
+            module.fail_json(msg="Can't process Xpath %s in order to spawn nodes! tree is %s" %
+                                 (xpath, _tree_snippet(tree)))
+            return False
+        segments.append((inner_xpath, changes))
+        if is_node(tree, inner_xpath, namespaces):
+            break
+        xpath = inner_xpath
 
     changed = False
+    for (inner_xpath, changes) in reversed(segments):
+        # the parent may still be missing in check mode, so test before
+        # applying this level's changes
+        if changes and is_node(tree, inner_xpath, namespaces):
+            if _apply_changes(module, tree, inner_xpath, changes, namespaces):
+                changed = True
+    return changed
 
-    if not is_node(tree, inner_xpath, namespaces):
-        changed = check_or_make_target(module, tree, inner_xpath, namespaces)
-
-    # we test again after calling check_or_make_target
-    if is_node(tree, inner_xpath, namespaces) and changes:
-        for (eoa, eoa_value) in changes:
-            if eoa and eoa[0] != '@' and eoa[0] != '/':
-                # implicitly creating an element
-                new_kids = children_to_nodes(module, [nsnameToClark(eoa, namespaces)], "yaml")
-                if eoa_value:
-                    for nk in new_kids:
-                        nk.text = eoa_value
-
-                for node in tree.xpath(inner_xpath, namespaces=namespaces):
-                    if not module.check_mode:
-                        node.extend(new_kids)
-                    changed = True
-                # module.fail_json(msg="now tree=%s" % etree.tostring(tree, pretty_print=True))
-            elif eoa and eoa[0] == '/':
-                element = eoa[1:]
-                new_kids = children_to_nodes(module, [nsnameToClark(element, namespaces)], "yaml")
-                for node in tree.xpath(inner_xpath, namespaces=namespaces):
-                    if not module.check_mode:
-                        node.extend(new_kids)
-                    for nk in new_kids:
-                        for subexpr in eoa_value:
-                            # module.fail_json(msg="element=%s subexpr=%s node=%s now tree=%s" %
-                            #                      (element, subexpr, etree.tostring(node, pretty_print=True), etree.tostring(tree, pretty_print=True))
-                            check_or_make_target(module, nk, "./" + subexpr, namespaces)
-                    changed = True
 
-                # module.fail_json(msg="now tree=%s" % etree.tostring(tree, pretty_print=True))
-            elif eoa == "":
-                for node in tree.xpath(inner_xpath, namespaces=namespaces):
-                    if (node.text != eoa_value):
-                        node.text = eoa_value
-                        changed = True
+def _apply_changes(module, tree, inner_xpath, changes, namespaces):
+    """ Apply one split_xpath_last changeset to the nodes matching
+    inner_xpath, returning whether anything changed """
+    changed = False
+
+    for (eoa, eoa_value) in changes:
+        if eoa and eoa[0] != '@' and eoa[0] != '/':
+            # implicitly creating an element
+            new_kids = children_to_nodes(module, [nsnameToClark(eoa, namespaces)], "yaml")
+            if eoa_value:
+                for nk in new_kids:
+                    nk.text = eoa_value
+
+            for node in xpath_eval(tree, inner_xpath, namespaces):
+                if not module.check_mode:
+                    node.extend(new_kids)
+                changed = True
+            # module.fail_json(msg="now tree=%s" % etree.tostring(tree, pretty_print=True))
+        elif eoa and eoa[0] == '/':
+            element = eoa[1:]
+            new_kids = children_to_nodes(module, [nsnameToClark(element, namespaces)], "yaml")
+            for node in xpath_eval(tree, inner_xpath, namespaces):
+                if not module.check_mode:
+                    node.extend(new_kids)
+                for nk in new_kids:
+                    for subexpr in eoa_value:
+                        # module.fail_json(msg="element=%s subexpr=%s node=%s now tree=%s" %
+                        #                      (element, subexpr, etree.tostring(node, pretty_print=True), etree.tostring(tree, pretty_print=True))
+                        check_or_make_target(module, nk, "./" + subexpr, namespaces)
+                changed = True
 
-            elif eoa and eoa[0] == '@':
-                attribute = nsnameToClark(eoa[1:], namespaces)
+            # module.fail_json(msg="now tree=%s" % etree.tostring(tree, pretty_print=True))
+        elif eoa == "":
+            for node in xpath_eval(tree, inner_xpath, namespaces):
+                if (node.text != eoa_value):
+                    node.text = eoa_value
+                    changed = True
 
-                for element in tree.xpath(inner_xpath, namespaces=namespaces):
-                    changing = (attribute not in element.attrib or element.attrib[attribute] != eoa_value)
+        elif eoa and eoa[0] == '@':
+            attribute = nsnameToClark(eoa[1:], namespaces)
 
-                    if not module.check_mode and changing:
-                        changed = changed or changing
-                        if eoa_value is None:
-                            value = ""
-                        else:
-                            value = eoa_value
-                        element.attrib[attribute] = value
+            for element in xpath_eval(tree, inner_xpath, namespaces):
+                changing = (attribute not in element.attrib or element.attrib[attribute] != eoa_value)
 
-                    # module.fail_json(msg="arf %s changing=%s as curval=%s changed tree=%s" %
-                    #       (xpath, changing, etree.tostring(tree, changing, element[attribute], pretty_print=True)))
+                if not module.check_mode and changing:
+                    changed = changed or changing
+                    if eoa_value is None:
+                        value = ""
+                    else:
+                        value = eoa_value
+                    element.attrib[attribute] = value
 
-            else:
-                module.fail_json(msg="unknown tree transformation=%s" % etree.tostring(tree, pretty_print=True))
+                # module.fail_json(msg="arf %s changing=%s as curval=%s changed tree=%s" %
+                #       (xpath, changing, etree.tostring(tree, changing, element[attribute], pretty_print=True)))
+
+        else:
+            module.fail_json(msg="unknown tree transformation=%s" % _tree_snippet(tree))
 
     return changed
 
@@ -466,31 +573,47 @@ def ensure_xpath_exists(module, tree, xpath, namespaces):
 def set_target_inner(module, tree, xpath, namespaces, attribute, value):
     changed = False
 
-    try:
-        if not is_node(tree, xpath, namespaces):
+    # One evaluation serves both the existence test and the update loop
+    elements = xpath_eval(tree, xpath, namespaces)
+    if not (elements and isinstance(elements[0], lxml.etree._Element)):
+        try:
             changed = check_or_make_target(module, tree, xpath, namespaces)
-    except Exception:
-        e = get_exception()
-        module.fail_json(msg="Xpath %s causes a failure: %s\n%s\n  -- tree is %s" %
-                             (xpath, e, traceback.format_exc(e), etree.tostring(tree, pretty_print=True)))
-
-    if not is_node(tree, xpath, namespaces):
-        module.fail_json(msg="Xpath %s does not reference a node! tree is %s" %
-                             (xpath, etree.tostring(tree, pretty_print=True)))
-
-    for element in tree.xpath(xpath, namespaces=namespaces):
+        except Exception:
+            e = get_exception()
+            module.fail_json(msg="Xpath %s causes a failure: %s\n%s\n  -- tree is %s" %
+                                 (xpath, e, traceback.format_exc(), _tree_snippet(tree)))
+
+        # check_or_make_target reports whether it changed anything; a
+        # False here means it could not build the target
+        if not changed:
+            module.fail_json(msg="Xpath %s does not reference a node! tree is %s" %
+                                 (xpath, _tree_snippet(tree)))
+
+        # the builder may have satisfied an attribute or text() xpath,
+        # whose string results this update loop cannot operate on
+        elements = xpath_eval(tree, xpath, namespaces)
+        if not (elements and isinstance(elements[0], lxml.etree._Element)):
+            module.fail_json(msg="Xpath %s does not reference a node! tree is %s" %
+                                 (xpath, _tree_snippet(tree)))
+
+    # the qualified-name construction is loop-invariant, do it once up
+    # front; QName hands libxml2 a structured identifier instead of a
+    # freshly formatted Clark string
+    if attribute and ":" in attribute:
+        attr_ns, attr_name = attribute.split(":")
+        attribute = etree.QName(namespaces[attr_ns], attr_name)
+
+    for element in elements:
         if not attribute:
-            changed = changed or (element.text != value)
-            if not module.check_mode and (element.text != value):
-                element.text = value
+            if element.text != value:
+                changed = True
+                if not module.check_mode:
+                    element.text = value
         else:
-            changed = changed or (element.get(attribute) != value)
-            if ":" in attribute:
-                attr_ns, attr_name = attribute.split(":")
-                # attribute = "{{%s}}%s" % (namespaces[attr_ns], attr_name)
-                attribute = "{{{0}}}{1}".format(namespaces[attr_ns], attr_name)
-            if not module.check_mode and (element.get(attribute) != value):
-                element.set(attribute, value)
+            if element.get(attribute) != value:
+                changed = True
+                if not module.check_mode:
+                    element.set(attribute, value)
 
     return changed
 
@@ -507,13 +630,21 @@ def pretty(module, tree):
     if module.params['path']:
         xml_file = module.params['path']
 
-        xml_content = open(xml_file)
-        try:
-            if xml_string != xml_content.read():
-                changed = True
-                tree.write(xml_file, xml_declaration=True, encoding='UTF-8', pretty_print=module.params['pretty_print'])
-        finally:
-            xml_content.close()
+        # Short-circuit on a size mismatch, otherwise compare in chunks so
+        # the original file never has to be slurped into memory
+        if os.stat(xml_file).st_size != len(xml_string):
+            changed = True
+        else:
+            offset = 0
+            with open(xml_file, 'rb') as xml_content:
+                for chunk in iter(lambda: xml_content.read(8192), b''):
+                    if xml_string[offset:offset + len(chunk)] != chunk:
+                        changed = True
+                        break
+                    offset += len(chunk)
+
+        if changed:
+            tree.write(xml_file, xml_declaration=True, encoding='UTF-8', pretty_print=module.params['pretty_print'])
 
         module.exit_json(changed=changed)
 
@@ -528,9 +659,7 @@ def get_element_text(module, tree, xpath, namespaces):
     if not is_node(tree, xpath, namespaces):
         module.fail_json(msg="Xpath %s does not reference a node!" % xpath)
 
-    elements = []
-    for element in tree.xpath(xpath, namespaces=namespaces):
-        elements.append({element.tag: element.text})
+    elements = [{element.tag: element.text} for element in xpath_eval(tree, xpath, namespaces)]
 
     finish(module, tree, xpath, namespaces, changed=False, msg=len(elements), hitcount=len(elements), matches=elements)
 
@@ -539,13 +668,9 @@ def get_element_attr(module, tree, xpath, namespaces):
     if not is_node(tree, xpath, namespaces):
         module.fail_json(msg="Xpath %s does not reference a node!" % xpath)
 
-    elements = []
-    for element in tree.xpath(xpath, namespaces=namespaces):
-        child = {}
-        for key in element.keys():
-            value = element.get(key)
-            child.update({key: value})
-        elements.append({element.tag: child})
+    # dict(element.attrib) materializes the whole attribute map in one C
+    # call instead of a get() round-trip per key
+    elements = [{element.tag: dict(element.attrib)} for element in xpath_eval(tree, xpath, namespaces)]
 
     finish(module, tree, xpath, namespaces, changed=False, msg=len(elements), hitcount=len(elements), matches=elements)
 
@@ -555,20 +680,19 @@ def child_to_element(module, child, in_type):
         infile = BytesIO(child.encode('utf-8'))
 
         try:
-            parser = etree.XMLParser()
-            node = etree.parse(infile, parser)
+            node = etree.parse(infile, _PARSER)
             return node.getroot()
         except etree.XMLSyntaxError:
             e = get_exception()
             module.fail_json(msg="Error while parsing child element: %s" % e)
     elif in_type == 'yaml':
-        if isinstance(child, str) or isinstance(child, unicode):
+        if isinstance(child, str):
             return etree.Element(child)
         elif isinstance(child, dict):
             if len(child) > 1:
                 module.fail_json(msg="Can only create children from hashes with one key")
 
-            (key, value) = child.items()[0]
+            (key, value) = next(iter(child.items()))
             if isinstance(value, dict):
                 children = value.pop('_', None)
 
@@ -602,7 +726,34 @@ def finish(module, tree, xpath, namespaces, changed=False, msg="", hitcount=0, m
         module.exit_json(changed=changed, actions=actions, msg=msg, count=hitcount, matches=matches)
 
     if module.params['path']:
-        tree.write(module.params['path'], xml_declaration=True, encoding='UTF-8', pretty_print=module.params['pretty_print'])
+        # In check mode the tree carries none of the suppressed mutations,
+        # so it serializes back to the source bytes and the hash shortcut
+        # would mask a pending change; report what would happen instead
+        if module.check_mode:
+            module.exit_json(changed=changed, actions=actions, msg=msg, count=hitcount, matches=matches)
+
+        xml_string = etree.tostring(tree, xml_declaration=True, encoding='UTF-8', pretty_print=module.params['pretty_print'])
+        if _src_hash is not None and hashlib.blake2b(xml_string).digest() == _src_hash:
+            # byte-identical to the source file; skip the write
+            module.exit_json(changed=False, actions=actions, msg=msg, count=hitcount, matches=matches)
+        tmp_path = module.params['path'] + '.tmp'
+        with open(tmp_path, 'wb') as xml_out:
+            xml_out.write(xml_string)
+        # carry the original file's mode and ownership over to the temp
+        # file so the replace doesn't silently widen permissions
+        try:
+            st = os.stat(module.params['path'])
+        except OSError:
+            # no existing file; leave the umask-default mode in place
+            st = None
+        if st is not None:
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            except OSError:
+                # not privileged to restore ownership; mode is preserved
+                pass
+        os.replace(tmp_path, module.params['path'])
         module.exit_json(changed=changed, actions=actions, msg=msg, count=hitcount, matches=matches)
 
     if module.params['xmlstring']:
@@ -611,10 +762,10 @@ def finish(module, tree, xpath, namespaces, changed=False, msg="", hitcount=0, m
 
 
 def decode(value):
-    # Convert value to unicode to use with lxml
-    if not value or isinstance(value, unicode):
+    # Convert value to text to use with lxml
+    if not value or isinstance(value, str):
         return value
-    elif isinstance(value, str):
+    elif isinstance(value, bytes):
         return value.decode('utf-8')
     elif isinstance(value, list):
         return [decode(v) for v in value]
@@ -666,7 +817,6 @@ def main():
     pretty_print = module.params['pretty_print']
     content = module.params['content']
     input_type = module.params['input_type']
-    print_match = module.params['print_match']
     count = module.params['count']
 
     if not HAS_LXML:
@@ -676,19 +826,50 @@ def main():
     if xml_string:
         infile = BytesIO(xml_string.encode('utf-8'))
     elif os.path.isfile(xml_file):
-        infile = file(xml_file, 'r')
+        infile = open(xml_file, 'rb')
     else:
         module.fail_json(msg="The target XML source does not exist: %s" % xml_file)
 
+    # count and content only observe the document, so for plain child-axis
+    # xpaths stream it with iterparse instead of materializing the full tree
+    if count or content in ('attribute', 'text'):
+        segments = simple_path_segments(xpath, namespaces)
+        if segments is not None:
+            actions = dict(xpath=xpath, namespaces=namespaces, state=state)
+            try:
+                if count:
+                    hits = sum(1 for unused in stream_matches(infile, segments))
+                    module.exit_json(changed=False, actions=actions, msg=hits, count=hits, matches=[])
+                elif content == 'attribute':
+                    matches = [{elem.tag: dict(elem.attrib)} for elem in stream_matches(infile, segments)]
+                else:
+                    matches = [{elem.tag: elem.text} for elem in stream_matches(infile, segments)]
+            except etree.XMLSyntaxError:
+                e = get_exception()
+                module.fail_json(msg="Error while parsing path: %s" % e)
+
+            if not matches:
+                module.fail_json(msg="Xpath %s does not reference a node!" % xpath)
+            module.exit_json(changed=False, actions=actions, msg=len(matches), count=len(matches), matches=matches)
+
+    # Capture a hash of the source bytes so finish() can detect writes
+    # that would not change the file
+    if xml_file:
+        global _src_hash
+        src_digest = hashlib.blake2b()
+        for chunk in iter(lambda: infile.read(65536), b''):
+            src_digest.update(chunk)
+        _src_hash = src_digest.digest()
+        infile.seek(0)
+
     # Try to parse in the target XML file
     try:
-        parser = etree.XMLParser(remove_blank_text=pretty_print)
-        x = etree.parse(infile, parser)
+        x = etree.parse(infile, _PARSER_PRETTY if pretty_print else _PARSER)
     except etree.XMLSyntaxError:
         e = get_exception()
         module.fail_json(msg="Error while parsing path: %s" % e)
 
-    if print_match:
+    if module.params['print_match']:
         print_match(module, x, xpath, namespaces)
 
     if count: